@@ -1,6 +1,9 @@
 import argparse
 import csv
+import io
+import multiprocessing
 import sys
+from itertools import combinations, islice
 
 
 class InconsistentState(RuntimeError):
@@ -9,17 +12,6 @@ class InconsistentState(RuntimeError):
     """
 
 
-def merge(*ds):
-    """
-    Merge several ``dict``s together.
-    """
-    res = {}
-    for d in ds:
-        if d:
-            res.update(d)
-    return res
-
-
 def to_sql_name(name):
     """
     Ensure ``name`` is a valid SQL name.
@@ -38,7 +30,9 @@ def serialize_text(value):
     """
     Serialize a text value.
     """
-    return "'{}'".format(quote_sql_string(value))
+    if "'" not in value:
+        return "'" + value + "'"
+    return "'" + quote_sql_string(value) + "'"
 
 
 def deserialize_yesno(value):
@@ -52,7 +46,7 @@ def serialize_yesno(value):
     """
     Serialize a boolean (yes or no) value.
     """
-    return str(1 if value else 0)
+    return '1' if value else '0'
 
 
 def deserialize_integer(value):
@@ -69,23 +63,38 @@ def serialize_integer(value):
     return str(value)
 
 
+# Size, in bytes, of the input and output file buffers.
+BUFFER_SIZE = 1 << 20
+
+# Approximate size, in bytes, of the input handed to each worker process.
+CHUNK_SIZE = 1 << 22
+
+# Maximum number of rows in a single multi-row ``INSERT`` statement.
+INSERT_BATCH_SIZE = 500
+
+
 class InOutType(object):
+    __slots__ = ('serialize', 'deserialize', 'is_sql', 'is_csv')
     sql_type = None
+    default_serialize = None
+    default_deserialize = None
     _nothing = object()
 
     def __init__(self, serialize=_nothing, deserialize=_nothing):
-        if serialize is not self._nothing:
-            self.serialize = serialize
-        if deserialize is not self._nothing:
-            self.deserialize = deserialize
-
-    @property
-    def is_sql(self):
-        return self.sql_type and self.serialize is not None
+        if serialize is self._nothing:
+            serialize = self.default_serialize
+        if deserialize is self._nothing:
+            deserialize = self.default_deserialize
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.is_sql = bool(self.sql_type) and serialize is not None
+        self.is_csv = deserialize is not None
 
-    @property
-    def is_csv(self):
-        return self.deserialize is not None
+    def __repr__(self):
+        return '<{} serialize={!r} deserialize={!r}>'.format(
+            type(self).__name__,
+            self.serialize,
+            self.deserialize)
 
     @classmethod
     def no_sql(cls):
@@ -97,27 +106,36 @@ class InOutType(object):
 
 
 class text(InOutType):
+    __slots__ = ()
     sql_type = 'TEXT'
-    serialize = staticmethod(serialize_text)
-    deserialize = staticmethod(deserialize_text)
+    default_serialize = staticmethod(serialize_text)
+    default_deserialize = staticmethod(deserialize_text)
 
 
 class integer(InOutType):
+    __slots__ = ()
     sql_type = 'INTEGER'
-    serialize = staticmethod(serialize_integer)
-    deserialize = staticmethod(deserialize_integer)
+    default_serialize = staticmethod(serialize_integer)
+    default_deserialize = staticmethod(deserialize_integer)
 
 
 class yesno(InOutType):
+    __slots__ = ()
     sql_type = 'INTEGER'
-    serialize = staticmethod(serialize_yesno)
-    deserialize = staticmethod(deserialize_yesno)
+    default_serialize = staticmethod(serialize_yesno)
+    default_deserialize = staticmethod(deserialize_yesno)
 
 
 class Column(object):
+    __slots__ = ('name', 'field_type', 'is_sql', 'is_csv')
+
     def __init__(self, name, field_type):
+        if isinstance(field_type, type):
+            field_type = field_type()
         self.name = to_sql_name(name)
         self.field_type = field_type
+        self.is_sql = field_type.is_sql
+        self.is_csv = field_type.is_csv
 
     def __repr__(self):
         return '<{} name={!r} field_type={!r}>'.format(
@@ -125,20 +143,54 @@ class Column(object):
             self.name,
             self.field_type)
 
-    @property
-    def is_sql(self):
-        return self.field_type.is_sql
-
-    @property
-    def is_csv(self):
-        return self.field_type.is_csv
-
 
 class Table(object):
+    __slots__ = (
+        'name', 'columns', 'foreign_keys',
+        '_sql_cols', '_sql_names', '_sql_serialize',
+        '_csv_cols', '_parse_idx', '_parse_names', '_parse_deserialize',
+        '_extra_names', '_name_to_idx', '_sql_idx', '_create_sql',
+        '_insert_templates')
+
     def __init__(self, name, columns, foreign_keys=[]):
         self.name = to_sql_name(name)
         self.columns = columns
         self.foreign_keys = foreign_keys
+        # The schema is static, so work out everything the per-row methods
+        # need once, up front.
+        self._sql_cols = tuple(c for c in columns if c.is_sql)
+        self._sql_names = tuple(c.name for c in self._sql_cols)
+        self._sql_serialize = tuple(
+            c.field_type.serialize for c in self._sql_cols)
+        self._csv_cols = tuple(c for c in columns if c.is_csv)
+        # Only CSV columns that make it into the SQL are deserialized.
+        parse_cols = [(i, c) for i, c in enumerate(self._csv_cols) if c.is_sql]
+        self._parse_idx = tuple(i for i, _ in parse_cols)
+        self._parse_names = tuple(c.name for _, c in parse_cols)
+        self._parse_deserialize = tuple(
+            c.field_type.deserialize for _, c in parse_cols)
+        # Rows are lists: the parsed CSV columns, in order, followed by the
+        # columns that are not read from the CSV.
+        self._extra_names = tuple(c.name for c in columns if not c.is_csv)
+        self._name_to_idx = {
+            name: i
+            for i, name in enumerate(self._parse_names + self._extra_names)}
+        self._sql_idx = tuple(self._name_to_idx[n] for n in self._sql_names)
+        self._create_sql = 'CREATE TABLE {} ({});'.format(
+            self.name,
+            ', '.join('{} {}'.format(col.name, col.field_type.sql_type)
+                      for col in self._sql_cols + tuple(foreign_keys)))
+        # One INSERT template for every subset of foreign keys that may be
+        # given for a row.
+        fk_names = tuple(fk_col.name for fk_col in foreign_keys)
+        self._insert_templates = {}
+        for n in range(len(fk_names) + 1):
+            for names in combinations(fk_names, n):
+                col_names = self._sql_names + names
+                self._insert_templates[names] = (
+                    'INSERT INTO {} ({}) VALUES '.format(
+                        self.name, ', '.join(col_names)),
+                    '({})'.format(', '.join(['{}'] * len(col_names))))
 
     def __repr__(self):
         return '<{} name={!r} columns={!r} foreign_keys={!r}>'.format(
@@ -149,38 +201,79 @@ class Table(object):
 
     @property
     def only_sql_columns(self):
-        return [c for c in self.columns if c.is_sql]
+        return list(self._sql_cols)
 
     @property
     def only_csv_columns(self):
-        return [c for c in self.columns if c.is_csv]
+        return list(self._csv_cols)
 
     def create_sql(self):
-        cols = self.only_sql_columns + self.foreign_keys
-        cols_sql = [
-            '{} {}'.format(col.name, col.field_type.sql_type)
-            for col in cols]
-        return 'CREATE TABLE {} ({});'.format(
-            self.name, ', '.join(cols_sql))
+        return self._create_sql
+
+    def _serialize_row(self, row, foreign_keys):
+        """
+        Serialize ``row``, and any ``foreign_keys``, into SQL values.
+
+        :return: Pair of the foreign key column names present, and the
+            serialized values.
+        """
+        data = [f(row[i])
+                for f, i in zip(self._sql_serialize, self._sql_idx)]
+        fk_names = []
+        if foreign_keys:
+            for fk_col in self.foreign_keys:
+                if fk_col.name in foreign_keys:
+                    fk_names.append(fk_col.name)
+                    data.append(
+                        fk_col.field_type.serialize(foreign_keys[fk_col.name]))
+        return tuple(fk_names), data
 
     def insert_sql(self, row, foreign_keys=None):
-        if foreign_keys:
-            fk_cols = [fk_col for fk_col in self.foreign_keys
-                       if fk_col.name in foreign_keys]
-        else:
-            fk_cols = []
-        columns = self.only_sql_columns + fk_cols
-        row = merge(row, foreign_keys or {})
-        col_names = [col.name for col in columns]
-        data = [col.field_type.serialize(row[col.name]) for col in columns]
-        return 'INSERT INTO {} ({}) VALUES ({});'.format(
-            self.name,
-            ', '.join(col_names),
-            ', '.join(data))
+        fk_names, data = self._serialize_row(row, foreign_keys)
+        prefix, values = self._insert_templates[fk_names]
+        return prefix + values.format(*data) + ';'
+
+    def insert_sql_batch(self, rows, batch_size=INSERT_BATCH_SIZE):
+        """
+        Generate multi-row ``INSERT`` statements for ``rows``.
+
+        :param rows: Iterable of ``(row, foreign_keys)`` pairs.
+        :param batch_size: Maximum number of rows per statement.
+        """
+        prefix, values = None, []
+        for row, foreign_keys in rows:
+            fk_names, data = self._serialize_row(row, foreign_keys)
+            row_prefix, template = self._insert_templates[fk_names]
+            if values and (row_prefix is not prefix or
+                           len(values) >= batch_size):
+                yield prefix + ', '.join(values) + ';'
+                values = []
+            prefix = row_prefix
+            values.append(template.format(*data))
+        if values:
+            yield prefix + ', '.join(values) + ';'
+
+    def row_index(self, name):
+        """
+        Get the position of the column ``name`` within a row.
+        """
+        return self._name_to_idx[name]
+
+    def extra_values(self, values):
+        """
+        Get the values, from the ``values`` mapping, of the columns that are
+        not read from the CSV, in the order they are appended to a row.
+        """
+        return [values[n] for n in self._extra_names]
 
     def parse_csv(self, data):
-        return {col.name: col.field_type.deserialize(v)
-                for (col, v) in zip(self.only_csv_columns, data)}
+        """
+        Parse CSV data into a row, without the columns that are not read from
+        the CSV. CSV columns that are not written to SQL, such as the record
+        type, are skipped rather than deserialized.
+        """
+        return [f(data[i])
+                for f, i in zip(self._parse_deserialize, self._parse_idx)]
 
 
 DATA_TYPE_HEADERS = {
@@ -239,6 +332,9 @@ DATA_TYPE_HEADERS = {
         ]),
 }
 
+CUST_TABLE = DATA_TYPE_HEADERS['CUST']
+REF_TABLE = DATA_TYPE_HEADERS['REF']
+
 
 def parse_headers(headers, data):
     """
@@ -247,15 +343,29 @@ def parse_headers(headers, data):
     return {k: f(v) for (k, (f, _), _), v in zip(headers, data)}
 
 
+def flush_customers(state):
+    """
+    Write out, and forget, the customers that have been processed so far.
+    """
+    customers = state.pop('customers', None)
+    if customers:
+        state['write_sql'](customers_sql(customers))
+    return state
+
+
 def exit_H_CUST(state):
     """
     Handle leaving the ``H_CUST`` state.
 
-    Add the customer data being processed to the list of all processed customers.
+    Add the customer data being processed to the list of processed customers,
+    writing them out once there are enough for a full ``INSERT`` batch.
     """
     current_customer = state.pop('current_customer', None)
     if current_customer:
-        state.setdefault('customers', []).append(current_customer)
+        customers = state.setdefault('customers', [])
+        customers.append(current_customer)
+        if len(customers) >= INSERT_BATCH_SIZE:
+            state = flush_customers(state)
     return state
 
 
@@ -265,7 +375,7 @@ def enter_final(state, data):
 
     Wrap up any lingering customer data.
     """
-    return exit_H_CUST(state)
+    return flush_customers(exit_H_CUST(state))
 
 
 def enter_CUST(state, data):
@@ -277,10 +387,9 @@ def enter_CUST(state, data):
     if state.get('current_customer'):
         raise InconsistentState(
             'Found unflushed CUST record when processing a new one')
-    row = merge(
-        DATA_TYPE_HEADERS['CUST'].parse_csv(data),
-        state.get('append_to_cust'))
-    state['current_customer'] = row
+    row = CUST_TABLE.parse_csv(data)
+    row.extend(state['append_to_cust'])
+    state['current_customer'] = (row, [])
     return state
 
 
@@ -294,21 +403,26 @@ def enter_REF(state, data):
     current_customer = state.get('current_customer')
     if not current_customer:
         raise InconsistentState('Found REF but no current customer')
-    references = current_customer.setdefault('references', [])
-    row = merge(
-        DATA_TYPE_HEADERS['REF'].parse_csv(data),
-        state.get('append_to_ref'))
-    references.append(row)
+    row = REF_TABLE.parse_csv(data)
+    row.extend(state['append_to_ref'])
+    current_customer[1].append(row)
     return state
 
 
 def enter_H(state, data):
-    extra = [
-        ('insert_date', data[7]),
-        ('insert_time', data[8]),
-        ]
-    state['append_to_ref'] = extra
-    state['append_to_cust'] = extra
+    """
+    Handle entering the ``H`` state.
+
+    Precompute the header values appended to every customer and reference
+    row. The state machine only reaches ``CUST`` and ``REF`` after an ``H``
+    record, so these are always present when those records are processed.
+    """
+    extra = {
+        'insert_date': data[7],
+        'insert_time': data[8],
+    }
+    state['append_to_ref'] = REF_TABLE.extra_values(extra)
+    state['append_to_cust'] = CUST_TABLE.extra_values(extra)
     return state
 
 
@@ -348,6 +462,39 @@ STATES = {
 }
 
 
+def build_transitions(states):
+    """
+    Build an integer transition table from a ``STATES`` structure.
+
+    :return: Triple of a list of state names (indexed by state id), a mapping
+        of state names to ids and a table where
+        ``transitions[current_id][next_id]`` is the new state id, or ``-1`` if
+        the transition is invalid. A ``next_id`` of ``-1`` (the last column)
+        represents a record type that is not a known state.
+    """
+    names = sorted(states)
+    ids = {name: i for i, name in enumerate(names)}
+    final = ids['__final__']
+    transitions = []
+    for current_id, name in enumerate(names):
+        valid_states = states[name].get('valid_states')
+        row = []
+        for next_name in names + [None]:
+            if valid_states is None:
+                row.append(final)
+            elif next_name in valid_states:
+                row.append(ids[next_name])
+            elif '*' in valid_states:
+                row.append(current_id)
+            else:
+                row.append(-1)
+        transitions.append(row)
+    return names, ids, transitions
+
+
+STATE_NAMES, STATE_ID, TRANSITIONS = build_transitions(STATES)
+
+
 def quote_sql_string(value):
     """
     Quote an SQL string.
@@ -355,55 +502,57 @@ def quote_sql_string(value):
     return value.replace("'", "''")
 
 
-def as_sql(state, create=True):
+def header_sql(create=True):
     """
-    Serialize the application state as SQL.
+    Generate the SQL that precedes any customer data.
     """
     yield 'BEGIN TRANSACTION;'
 
-    ref_table = DATA_TYPE_HEADERS['REF']
-    cust_table = DATA_TYPE_HEADERS['CUST']
-
     if create:
         yield ''
         yield '-- Create tables'
-        yield ref_table.create_sql()
-        yield cust_table.create_sql()
+        yield REF_TABLE.create_sql()
+        yield CUST_TABLE.create_sql()
 
     yield ''
+    yield '-- Customers'
 
-    customers = state.get('customers')
-    if customers:
-        yield '-- Customers'
-        for customer in customers:
-            yield cust_table.insert_sql(customer)
-            for ref in customer.get('references', []):
-                yield ref_table.insert_sql(ref, foreign_keys={
-                    'customer_code': customer['customer_code'],
-                })
 
-    yield ''
+def customers_sql(customers):
+    """
+    Serialize processed customers, and their references, as SQL.
 
+    :param customers: Iterable of ``(customer, references)`` row pairs.
+    """
+    customer_code = CUST_TABLE.row_index('customer_code')
+    for line in CUST_TABLE.insert_sql_batch(
+            (customer, None) for customer, _ in customers):
+        yield line
+    for line in REF_TABLE.insert_sql_batch(
+            (ref, {'customer_code': customer[customer_code]})
+            for customer, references in customers
+            for ref in references):
+        yield line
+
+
+def footer_sql():
+    """
+    Generate the SQL that follows all customer data.
+    """
+    yield ''
     yield 'COMMIT;'
 
 
 def fsm(action, data):
     """
-    Finite-state machine to process an action and data, possibly leading to a
-    new action.
+    Finite-state machine to process an action (a state id) and data, possibly
+    leading to a new action.
     """
-    valid_states = action.get('valid_states')
-    if valid_states is None:
-        return STATES['__final__']
-
-    maybe_next = data[0]
-    if maybe_next in valid_states:
-        return STATES[maybe_next]
-    elif '*' in valid_states:
-        return action
-    else:
+    new_action = TRANSITIONS[action][STATE_ID.get(data[0], -1)]
+    if new_action < 0:
         raise RuntimeError('Expected one of {!r} but got {!r}'.format(
-            valid_states, maybe_next))
+            STATES[STATE_NAMES[action]]['valid_states'], data[0]))
+    return new_action
 
 
 def parse_command_line():
@@ -425,35 +574,135 @@ def parse_command_line():
         '--create',
         action='store_true',
         help='Include SQL "CREATE TABLE" commands.')
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of worker processes to convert customers with.')
     return parser.parse_args()
 
 
-def main():
-    args = parse_command_line()
-    reader = csv.reader(args.input_file, delimiter=';')
-    state, action = {}, STATES['__initial__']
-    while reader:
-        data = next(reader, None)
-        # XXX:
-        if data is None:
-            break
+def buffered(f, mode):
+    """
+    Reopen the file ``f`` with a ``BUFFER_SIZE`` buffer, leaving the
+    underlying file descriptor open.
+    """
+    return io.open(f.fileno(), mode, buffering=BUFFER_SIZE, closefd=False)
+
+
+def read_records(input_file):
+    """
+    Read ``;``-delimited records from ``input_file``.
+
+    The dump-file mixes several record types, each with its own number of
+    fields, so it cannot be read as a single rectangular table.
+    """
+    return csv.reader(input_file, delimiter=';')
+
+
+def run(records, write_sql):
+    """
+    Drive the finite-state machine over ``records``, passing generated SQL
+    lines to ``write_sql`` as customers are processed.
+    """
+    actions = [STATES[name] for name in STATE_NAMES]
+    state, action = {'write_sql': write_sql}, STATE_ID['__initial__']
+    for data in records:
         new_action = fsm(action, data)
         if new_action != action:
-            exitf = action.get('exit')
+            exitf = actions[action].get('exit')
             if exitf:
                 state = exitf(state)
 
-        enterf = new_action.get('enter')
+        enterf = actions[new_action].get('enter')
         if enterf:
             state = enterf(state, data)
 
-        if new_action.get('final'):
+        if actions[new_action].get('final'):
             break
 
         action = new_action
+    return flush_customers(exit_H_CUST(state))
+
 
-    args.output_file.write(
-        '\n'.join(as_sql(state, create=args.create)))
+def record_type(line):
+    """
+    Get the record type of a raw input line.
+    """
+    return line.split(';', 1)[0].rstrip('\r\n')
+
+
+def split_input(input_file, chunk_size=CHUNK_SIZE):
+    """
+    Split raw input lines into chunks of roughly ``chunk_size`` bytes that can
+    be converted independently.
+
+    Chunks are only split before an ``H_CUST`` record, so customers and their
+    references are never separated, and every chunk after the first is
+    prefixed with the ``H`` record. Nothing is split once a record that ends
+    processing, such as ``MEDIUM``, has been seen.
+    """
+    header, lines, size, ended = None, [], 0, False
+    for line in input_file:
+        if not ended:
+            kind = record_type(line)
+            if kind == 'H' and header is None:
+                header = line
+            elif kind == 'H_CUST' and size >= chunk_size:
+                yield ''.join(lines)
+                lines, size = [header] if header else [], 0
+            elif 'valid_states' not in STATES.get(kind, {'valid_states': ()}):
+                ended = True
+        lines.append(line)
+        size += len(line)
+    if lines:
+        yield ''.join(lines)
+
+
+def convert_chunk(chunk):
+    """
+    Convert a chunk of raw input, from `split_input`, to SQL text.
+    """
+    lines = []
+    run(read_records(chunk.splitlines(True)), lines.extend)
+    return ''.join(line + '\n' for line in lines)
+
+
+def run_parallel(input_file, write, jobs):
+    """
+    Convert ``input_file`` using ``jobs`` worker processes, passing the SQL
+    text to ``write`` in input order.
+    """
+    pool = multiprocessing.Pool(jobs)
+    try:
+        chunks = split_input(input_file)
+        while True:
+            # Only read a few chunks ahead, to keep memory use bounded.
+            window = list(islice(chunks, jobs * 2))
+            if not window:
+                break
+            for sql in pool.map(convert_chunk, window):
+                write(sql)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main():
+    args = parse_command_line()
+    input_file = buffered(args.input_file, 'rb')
+    output_file = buffered(args.output_file, 'wb')
+
+    def write_sql(lines):
+        output_file.writelines(line + '\n' for line in lines)
+
+    write_sql(header_sql(create=args.create))
+    if args.jobs > 1:
+        run_parallel(input_file, output_file.write, args.jobs)
+    else:
+        run(read_records(input_file), write_sql)
+    write_sql(footer_sql())
+    output_file.flush()
 
 
 if __name__ == '__main__':